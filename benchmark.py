@@ -0,0 +1,63 @@
+"""
+Import / startup time of peewee_syncer (for short lived, cron driven runs)
+and checkpoint save latency of the local log store
+
+python benchmark.py [runs]
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+BENCHMARKS = [
+    ("python", "pass"),
+    ("import peewee", "import peewee"),
+    ("import peewee_syncer", "import peewee_syncer"),
+    ("cli --help", "import sys; sys.argv = ['peewee-syncer', '--help']; from peewee_syncer.cli import main; main()"),
+]
+
+OPTIONAL_MODULES = ('asyncio', 'backoff', 'dateutil', 'playhouse.db_url')
+
+
+def timeit(code):
+    timings = []
+
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, check=False)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), sorted(timings)[len(timings) // 2]
+
+
+def loaded_modules(code):
+    code = "{}; import sys; print(' '.join(m for m in {!r} if m in sys.modules))".format(code, OPTIONAL_MODULES)
+    return subprocess.check_output([sys.executable, "-c", code]).decode().strip()
+
+
+for name, code in BENCHMARKS:
+    best, median = timeit(code)
+    print("{:<22} min={:7.1f}ms median={:7.1f}ms".format(name, best * 1000, median * 1000))
+
+print("optional modules loaded by import peewee_syncer: {}".format(loaded_modules("import peewee_syncer") or "none"))
+
+
+def checkpoint_latency(n=10000):
+    from peewee_syncer import LogCheckpointStore
+
+    with tempfile.TemporaryDirectory() as path:
+        store = LogCheckpointStore(os.path.join(path, "checkpoint.log"), start=0)
+
+        start = time.perf_counter()
+        for i in range(n):
+            store.set_last_offset(i, 0)
+            store.save()
+        store.close()
+
+        return (time.perf_counter() - start) / n
+
+
+print("LogCheckpointStore.save {:7.1f}us".format(checkpoint_latency() * 1000000))
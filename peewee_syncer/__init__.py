@@ -1,3 +1,4 @@
 from .processor import AsyncProcessor, Processor, LastOffsetQueryIterator
-from .models import SyncManager
+from .models import SyncManager, LeaseLost
+from .stores import CheckpointStore, LogCheckpointStore
 from .utils import *
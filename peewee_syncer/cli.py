@@ -0,0 +1,114 @@
+import json
+import logging
+import argparse
+import importlib
+from .models import SyncManager
+from .processor import Processor
+from .stores import LogCheckpointStore
+from .utils import get_sync_manager
+
+log = logging.getLogger('peewee_syncer')
+
+PROCESSOR_OPTIONS = ('sleep_duration', 'persistent_connection', 'linger_rows', 'linger_ms', 'lease_owner', 'lease_duration',
+                     'process_max_tries', 'spill_bytes')
+
+
+def load_object(path):
+    # "package.module:attribute"
+    module_name, _, attr = path.partition(":")
+    obj = importlib.import_module(module_name)
+
+    for name in attr.split(".") if attr else []:
+        obj = getattr(obj, name)
+
+    return obj
+
+
+def load_database(value):
+    if "://" in value:
+        # playhouse.db_url pulls in every backend, only import when used
+        from playhouse.db_url import connect
+        return connect(value)
+
+    return load_object(value)
+
+
+def load_config(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def get_start(app, start):
+    # start is only used the first time a job is run
+    with SyncManager.get_db().connection_context():
+        if SyncManager.select().where(SyncManager.app == app).exists():
+            return None
+
+    return start
+
+
+def run_job(job, lease_owner=None):
+    app = job['app']
+
+    if lease_owner:
+        job = dict(job, lease_owner=lease_owner)
+
+    if 'checkpoint_log' in job:
+        sync_manager = LogCheckpointStore(job['checkpoint_log'], app=app, start=job.get('start'))
+    else:
+        sync_manager = get_sync_manager(app=app, start=get_start(app, job.get('start')))
+
+    processor = Processor(
+        sync_manager=sync_manager,
+        it_function=load_object(job['it_function']),
+        process_function=load_object(job['process_function']),
+        **{k: job[k] for k in PROCESSOR_OPTIONS if k in job}
+    )
+
+    log.info("Running {}".format(app))
+
+    try:
+        processor.process(limit=job['limit'], stop_when_caught_up=True, max_bytes=job.get('max_bytes'))
+    finally:
+        if isinstance(sync_manager, LogCheckpointStore):
+            sync_manager.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="peewee-syncer", description="Run sync jobs until caught up")
+    parser.add_argument("config", help="JSON config file")
+    parser.add_argument("--job", action="append", dest="jobs", metavar="APP", help="Only run this job (can be repeated)")
+    parser.add_argument("--create-table", action="store_true", help="Create the sync_manager (and sync_lease when leasing) tables if missing")
+    parser.add_argument("--lease-owner", help="Only run jobs not leased by another owner (eg hostname)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(name)s %(levelname)s %(message)s")
+
+    config = load_config(args.config)
+
+    if 'database' in config:
+        SyncManager.init_db(load_database(config['database']))
+
+    jobs = config['jobs']
+
+    if args.create_table:
+        SyncManager.create_table()
+
+        if args.lease_owner or any(job.get('lease_owner') for job in jobs):
+            SyncManager.create_lease_table()
+
+    if args.jobs:
+        missing = set(args.jobs) - set(job['app'] for job in jobs)
+        if missing:
+            parser.error("Unknown job(s): {}".format(", ".join(sorted(missing))))
+
+        jobs = [job for job in jobs if job['app'] in args.jobs]
+
+    for job in jobs:
+        run_job(job, lease_owner=args.lease_owner)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,70 @@
 import json
-from datetime import date
 from datetime import datetime
 
-from dateutil import parser
-from peewee import Model, Proxy, CharField, DateTimeField, TextField
+from peewee import Model, Proxy, CharField, DateTimeField, TextField, IntegerField, SQL, fn, \
+    PostgresqlDatabase, MySQLDatabase
+from .stores import CheckpointStore
 
 
-class SyncManager(Model):
+class LeaseLost(Exception):
+    pass
+
+
+def unwrap_db(db):
+    return db.obj if isinstance(db, Proxy) else db
+
+
+def db_now(db):
+    # Database clock in UTC (lease_expires is naive), so expiry isn't affected by clock skew
+    # or session time zones between hosts
+    db = unwrap_db(db)
+
+    if isinstance(db, PostgresqlDatabase):
+        return SQL("(CURRENT_TIMESTAMP AT TIME ZONE 'UTC')")
+
+    if isinstance(db, MySQLDatabase):
+        return SQL("UTC_TIMESTAMP()")
+
+    # sqlite CURRENT_TIMESTAMP is always utc
+    return SQL("CURRENT_TIMESTAMP")
+
+
+def db_expiry(db, duration):
+    db = unwrap_db(db)
+
+    if isinstance(db, PostgresqlDatabase):
+        return SQL("(CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + %s * INTERVAL '1 second'", (duration,))
+
+    if isinstance(db, MySQLDatabase):
+        return SQL("UTC_TIMESTAMP() + INTERVAL %s SECOND", (duration,))
+
+    # sqlite (same format as CURRENT_TIMESTAMP)
+    return fn.datetime('now', '{:+d} seconds'.format(int(duration)))
+
+
+class SyncLease(Model):
+    """
+    Lease on an app (owner, expiry and fencing token incremented on every acquire/steal)
+    Kept out of sync_manager so it is only needed when leasing. Uses the SyncManager database
+    """
+    app = CharField(max_length=256, primary_key=True)
+    owner = CharField(max_length=256, null=True)
+    lease_expires = DateTimeField(null=True)
+    token = IntegerField(default=0)
+
+    class Meta:
+        table_name = "sync_lease"
+        database = Proxy()
+
+
+class SyncManager(Model, CheckpointStore):
     app = CharField(max_length=256, primary_key=True)
     meta = TextField(default="{}")
     modified = DateTimeField(null=True)
 
     is_test_run = False
+    lease_owner = None
+    lease_token = None
 
     @classmethod
     def init_db(cls, db):
@@ -45,27 +98,106 @@ class SyncManager(Model):
         self.modified = datetime.now()
         return super(SyncManager, self).save(*args, **kwargs)
 
-    def get_last_offset(self):
+    def refresh(self):
+        cls = type(self)
+        self.__data__ = dict(cls.get(cls.app == self.app).__data__)
+        self._dirty.clear()
 
-        meta = self.get_meta()
-        value = meta.pop('value', None)
-        value_type = meta.pop('type', None)
-        offset = meta.pop('offset', None)
+    @classmethod
+    def get_lease_model(cls):
+        SyncLease.bind(cls.get_db())
+        return SyncLease
 
-        if value_type == 'date':
-            value = parser.parse(value)
+    @classmethod
+    def create_lease_table(cls):
+        cls.get_lease_model().create_table()
 
-        return {'value': value, 'offset': offset}
+    def get_lease(self):
+        lease = self.get_lease_model()
+        return lease.get_or_none(lease.app == self.app)
 
-    def set_last_offset(self, value, offset=0):
+    def set_lease(self, lease):
+        self.lease_owner = lease.owner if lease else None
+        self.lease_token = lease.token if lease else None
 
-        value_type = None
+    def is_lease_holder(self):
+        lease = self.get_lease_model()
+        return (lease.app == self.app) & (lease.owner == self.lease_owner) & (lease.token == self.lease_token)
+
+    def take_lease(self, owner, query):
+        # Read back in the same transaction (the updated row stays locked) so a concurrent steal
+        # can't be recorded as ours
+        lease = self.get_lease_model()
+
+        with self.get_db().atomic():
+            lease.insert(app=self.app).on_conflict_ignore().execute()
+
+            if not query(lease).execute():
+                return False
+
+            self.set_lease(lease.get((lease.app == self.app) & (lease.owner == owner)))
+
+            # Pick up the meta saved by the previous owner
+            self.refresh()
+
+        return True
+
+    def acquire_lease(self, owner, duration):
+        db = self.get_db()
+
+        return self.take_lease(owner, lambda lease: (
+            lease
+            .update(owner=owner, lease_expires=db_expiry(db, duration), token=lease.token + 1)
+            .where((lease.app == self.app) & (lease.owner.is_null() | (lease.owner == owner) | (lease.lease_expires < db_now(db))))
+        ))
+
+    def renew_lease(self, duration):
+        lease = self.get_lease_model()
+
+        n = (lease
+             .update(lease_expires=db_expiry(self.get_db(), duration))
+             .where(self.is_lease_holder())
+             .execute())
+
+        return n == 1
+
+    def steal_lease(self, owner, duration):
+        db = self.get_db()
+
+        def query(lease):
+            token = lease.get(lease.app == self.app).token
+
+            return (lease
+                    .update(owner=owner, lease_expires=db_expiry(db, duration), token=token + 1)
+                    .where((lease.app == self.app) & (lease.token == token)))
+
+        return self.take_lease(owner, query)
+
+    def release_lease(self):
+        lease = self.get_lease_model()
+
+        n = (lease
+             .update(owner=None, lease_expires=None)
+             .where(self.is_lease_holder())
+             .execute())
+
+        self.set_lease(None)
+
+        return n == 1
+
+    def save_fenced(self):
+        # Only save the checkpoint if the lease is still ours (single conditional UPDATE)
+        cls = type(self)
+        lease = self.get_lease_model()
+        self.modified = datetime.now()
 
-        if isinstance(value, datetime) or isinstance(value, date):
-            value = value.isoformat()
-            value_type = "date"
+        n = (cls
+             .update(meta=self.meta, modified=self.modified)
+             .where((cls.app == self.app) & fn.EXISTS(lease.select(SQL("1")).where(self.is_lease_holder())))
+             .execute())
 
-        self.set_meta({'value': value, "type": value_type, 'offset': offset})
+        if not n:
+            raise LeaseLost("Lease lost for {} (owner={} token={})".format(self.app, self.lease_owner, self.lease_token))
 
     class Meta:
         table_name = "sync_manager"
@@ -1,29 +1,92 @@
 import time
 import os
+import sys
+import inspect
+import functools
 import itertools
 import logging
-import asyncio
-import backoff
 from peewee import OperationalError
 from collections import deque
+from .models import SyncManager, LeaseLost
 
 log = logging.getLogger('peewee_syncer')
 
 PEEWEE_SYNC_BACKOFF_MAX_RETRIES = int(os.environ.get("PEEWEE_SYNC_BACKOFF_MAX_RETRIES", "8"))
 
 
+def reset_connection(details):
+    # backoff handler, drop the (possibly broken) connection so the next try reconnects
+    details['args'][0].reset_connection()
+
+
+def retry_on_operational_error(on_backoff=None):
+    """
+    backoff.on_exception() on OperationalError, applied on first call
+    (backoff imports asyncio, which is slow to import for short lived sync runs)
+    """
+
+    def decorator(f):
+        retrying = None
+
+        def get_retrying():
+            nonlocal retrying
+            if retrying is None:
+                import backoff
+                retrying = backoff.on_exception(backoff.expo, (OperationalError,), max_tries=PEEWEE_SYNC_BACKOFF_MAX_RETRIES,
+                                                on_backoff=on_backoff)(f)
+            return retrying
+
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def inner(*args, **kwargs):
+                return await get_retrying()(*args, **kwargs)
+        else:
+            @functools.wraps(f)
+            def inner(*args, **kwargs):
+                return get_retrying()(*args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+def estimate_size(row):
+    # Rough in memory size of a row (model instance, dict, tuple or scalar)
+    if hasattr(row, '__data__'):
+        row = row.__data__
+
+    if isinstance(row, dict):
+        return sum(estimate_size(v) for v in row.values())
+
+    if isinstance(row, (list, tuple)):
+        return sum(estimate_size(v) for v in row)
+
+    if isinstance(row, (str, bytes, bytearray)):
+        return len(row)
+
+    return sys.getsizeof(row)
+
+
 class LastOffsetQueryIterator:
-    def __init__(self, i, row_output_fun, key_fun, is_unique_key=False):
+    def __init__(self, i, row_output_fun, key_fun, is_unique_key=False, max_bytes=None, size_fun=estimate_size):
         self.iterator = i
         self.n = 0
         self.row_output_fun = row_output_fun
         self.last_updates = deque([None], maxlen=2)
         self.key_fun = key_fun
         self.is_unique_key = is_unique_key
+        self.max_bytes = max_bytes
+        self.size_fun = size_fun
+        self.bytes = 0
+        self.is_truncated = False
+
+    def is_limit_reached(self, limit):
+        # Either a full batch or stopped early by the byte budget (ie there may be more rows with the last key)
+        return self.n == limit or self.is_truncated
 
     def get_last_offset(self, limit):
         # log.debug("Offsets {} n={} limit={}".format(self.last_updates, self.n, limit))
-        if self.n == limit and not self.is_unique_key:
+        if self.is_limit_reached(limit) and not self.is_unique_key:
             return self.last_updates[0]
         else:
             return self.last_updates[-1]
@@ -40,13 +103,163 @@ class LastOffsetQueryIterator:
             if output:
                 yield output
 
+            if self.max_bytes:
+                self.bytes += self.size_fun(row)
+
+                if self.bytes >= self.max_bytes:
+                    log.debug("Byte budget reached after {} records ({} bytes)".format(self.n, self.bytes))
+                    self.is_truncated = True
+                    return
+
+
+class BatchBuffer:
+    """
+    Replayable copy of a batch (so the sink can be retried without re-fetching),
+    spilled to a temp file once spill_bytes is reached
+    """
+
+    def __init__(self, it, spill_bytes=None, size_fun=estimate_size):
+        self.rows = []
+        self.file = None
+        self.n = 0
+        self.bytes = 0
+
+        for row in it:
+            self.n += 1
+
+            if self.file:
+                self.dump(row)
+                continue
+
+            self.rows.append(row)
+
+            if spill_bytes:
+                self.bytes += size_fun(row)
+
+                if self.bytes >= spill_bytes:
+                    self.spill()
+
+    def __len__(self):
+        return self.n
+
+    def dump(self, row):
+        import pickle
+        pickle.dump(row, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def spill(self):
+        import tempfile
+        log.debug("Spilling batch to disk after {} records ({} bytes)".format(self.n, self.bytes))
+
+        self.file = tempfile.TemporaryFile()
+
+        for row in self.rows:
+            self.dump(row)
+
+        self.rows = []
+
+    def __iter__(self):
+        if self.file is None:
+            yield from self.rows
+            return
+
+        import pickle
+        self.file.seek(0)
+
+        for _ in range(self.n):
+            yield pickle.load(self.file)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class LingerBuffer:
+    """
+    Holds fetched rows (and their pending checkpoint) until either max_rows or max_ms is reached
+    """
+
+    def __init__(self, max_rows=None, max_ms=None):
+        self.max_rows = max_rows
+        self.max_ms = max_ms
+        self.rows = []
+        self.offset = None
+        self.started = None
+
+    def is_pending(self):
+        return self.started is not None
+
+    def start(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def set_last_offset(self, value, offset=0):
+        # Checkpoint to save once the held rows have been processed
+        self.start()
+        self.offset = {'value': value, 'offset': offset}
+
+    def get_last_offset(self):
+        return dict(self.offset) if self.offset else None
+
+    def add(self, it):
+        rows = list(it)
+
+        if rows:
+            self.start()
+            self.rows.extend(rows)
+
+    def get_remaining(self):
+        # Seconds until the held rows must be flushed
+        if not self.is_pending() or not self.max_ms:
+            return None
+
+        return max(0.0, self.max_ms / 1000 - (time.monotonic() - self.started))
+
+    def is_ready(self):
+        if not self.is_pending():
+            return False
+
+        if self.max_rows and len(self.rows) >= self.max_rows:
+            return True
+
+        return self.get_remaining() == 0
+
+    def clear(self):
+        self.rows = []
+        self.offset = None
+        self.started = None
+
 
 class Processor:
-    def __init__(self, sync_manager, it_function, process_function, sleep_duration=3):
+    def __init__(self, sync_manager, it_function, process_function, sleep_duration=3, persistent_connection=False,
+                 linger_rows=None, linger_ms=None, lease_owner=None, lease_duration=60,
+                 process_max_tries=1, process_retry_exceptions=(Exception,), spill_bytes=None):
         self.it_function = it_function
         self.process_function = process_function
         self.sync_manager = sync_manager
         self.sleep_duration = sleep_duration
+        # Hold one connection for the life of process() rather than connect/close per checkpoint
+        # (use a playhouse.pool database to have it handed back to the pool afterwards)
+        self.persistent_connection = persistent_connection
+        # Health check (eg a ping on MySQL) only on first use and after an idle sleep or an error
+        self.check_connection = True
+        # Micro batching, hold rows until linger_rows have accumulated. linger_ms caps the added latency
+        self.linger_rows = linger_rows
+        self.linger_ms = linger_ms
+        # Only checkpoint while holding the sync_manager lease (renewed at half the duration)
+        self.lease_owner = lease_owner
+        self.lease_duration = lease_duration
+        self.lease_renewed = None
+        # Retry process_function (with backoff) on the buffered batch rather than re-running the source query
+        self.process_max_tries = process_max_tries
+        self.process_retry_exceptions = process_retry_exceptions
+        self.spill_bytes = spill_bytes
+
+        # Kept across process() calls so held rows survive a failed flush
+        self.linger = self.get_linger_buffer()
+
+        if lease_owner is not None and not isinstance(sync_manager, SyncManager):
+            raise Exception("Leases require a SyncManager checkpoint store")
 
     @classmethod
     def should_stop(cls, i, n):
@@ -55,51 +268,230 @@ class Processor:
             return True
         return False
 
-    @backoff.on_exception(backoff.expo,  (OperationalError,), max_tries=PEEWEE_SYNC_BACKOFF_MAX_RETRIES)
+    def get_db(self):
+        return self.sync_manager.get_db()
+
+    def connect(self):
+        db = self.get_db()
+
+        if db is None:
+            return
+
+        # Missing on older peewee (setup.py allows 3.8.1), a broken connection is then only reset on error (retry)
+        is_usable = getattr(db, 'is_connection_usable', None)
+
+        if self.check_connection:
+            if is_usable and not db.is_closed() and not is_usable():
+                log.warning("Connection unusable, reconnecting..")
+                self.reset_connection()
+
+            self.check_connection = False
+
+        db.connect(reuse_if_open=True)
+
+    def reset_connection(self):
+        self.check_connection = True
+        db = self.get_db()
+
+        if db is None or db.is_closed():
+            return
+
+        # Pooled databases would otherwise return the broken connection to the pool
+        if hasattr(db, 'manual_close'):
+            db.manual_close()
+        else:
+            db.close()
+
+    def close(self):
+        db = self.get_db()
+
+        if db is not None and not db.is_closed():
+            db.close()
+
+    @retry_on_operational_error(on_backoff=reset_connection)
     def get_last_offset_and_iterator(self, limit):
-        last_offset = self.sync_manager.get_last_offset()
+        if self.persistent_connection:
+            self.connect()
+
+        last_offset = self.get_last_offset()
 
         it = self.it_function(since=last_offset['value'], limit=limit, offset=last_offset['offset'])
 
         return last_offset, it
 
+    def get_last_offset(self):
+        # Continue after any rows held (but not yet checkpointed) by the linger buffer
+        if self.linger and self.linger.offset:
+            return self.linger.get_last_offset()
+
+        return self.sync_manager.get_last_offset()
+
+    def run(self, fun):
+        if self.get_db() is None:
+            return fun()
+
+        if self.persistent_connection:
+            self.connect()
+            return fun()
+
+        with self.get_db().connection_context():
+            return fun()
+
+    def is_leased(self):
+        return self.lease_owner is not None and not self.sync_manager.is_test_run
+
+    def acquire_lease(self):
+        acquired = self.run(lambda: self.sync_manager.acquire_lease(owner=self.lease_owner, duration=self.lease_duration))
+
+        if acquired:
+            self.lease_renewed = time.monotonic()
+
+            # Rows held before this lease may since have been checkpointed by another owner,
+            # continue from the checkpoint just loaded instead
+            if self.linger:
+                self.linger.clear()
+        else:
+            log.info("Lease for {} held by another owner, skipping..".format(self.sync_manager.app))
+
+        return acquired
+
+    def renew_lease(self):
+        # Local monotonic clock only decides when to renew, expiry itself uses the database clock
+        if time.monotonic() - self.lease_renewed < self.lease_duration / 2:
+            return
+
+        if not self.run(lambda: self.sync_manager.renew_lease(duration=self.lease_duration)):
+            raise LeaseLost("Lease lost for {} (owner={})".format(self.sync_manager.app, self.lease_owner))
+
+        self.lease_renewed = time.monotonic()
+
+    def release_lease(self):
+        try:
+            self.run(self.sync_manager.release_lease)
+        except OperationalError as e:
+            # Expires by itself
+            log.warning("Failed to release lease: {}".format(e))
+
+    @retry_on_operational_error(on_backoff=reset_connection)
     def save(self):
-        with self.sync_manager.get_db().connection_context():
-            self.sync_manager.save()
+        if self.is_leased():
+            self.run(self.sync_manager.save_fenced)
+        else:
+            self.run(self.sync_manager.save)
 
-    def update_offset(self, it, limit, last_offset):
+    def update_offset(self, it, limit, last_offset, store=None):
+        store = store or self.sync_manager
         final_offset = it.get_last_offset(limit=limit)
 
         if final_offset and final_offset != last_offset['value']:
-            self.sync_manager.set_last_offset(value=final_offset, offset=0)
+            store.set_last_offset(value=final_offset, offset=0)
             return True
         else:
             # ID based, either we got none/some records and therefor offset should have changed
             if it.is_unique_key:
                 raise Exception("Aborting Sync. Perhaps your key is not unique?")
 
-            if it.n == limit:
-                offset = last_offset['offset'] + limit
-                self.sync_manager.set_last_offset(value=last_offset['value'], offset=offset)
+            if it.is_limit_reached(limit):
+                offset = last_offset['offset'] + it.n
+                store.set_last_offset(value=last_offset['value'], offset=offset)
                 log.warning("Limit reached. Offsetting @ {}".format(offset))
                 return True
             else:
                 log.debug("Final offset remains unchanged")
                 return False
 
-    def process(self, limit, i=0, stop_when_caught_up=False):
+    def process(self, limit, i=0, stop_when_caught_up=False, max_bytes=None):
+        try:
+            if self.is_leased():
+                if not self.acquire_lease():
+                    return
+
+                try:
+                    return self._process(limit=limit, i=i, stop_when_caught_up=stop_when_caught_up, max_bytes=max_bytes)
+                finally:
+                    self.release_lease()
+
+            return self._process(limit=limit, i=i, stop_when_caught_up=stop_when_caught_up, max_bytes=max_bytes)
+        finally:
+            self.sync_manager.flush()
+
+            if self.persistent_connection:
+                self.close()
+
+    def get_linger_buffer(self):
+        if self.sync_manager.is_test_run or not (self.linger_rows or self.linger_ms):
+            return None
+
+        return LingerBuffer(max_rows=self.linger_rows, max_ms=self.linger_ms)
+
+    def is_retrying_process(self):
+        return self.process_max_tries > 1
+
+    def run_process_function(self, rows):
+        if not self.is_retrying_process():
+            return self.process_function(iter(rows))
+
+        import backoff
+
+        @backoff.on_exception(backoff.expo, self.process_retry_exceptions, max_tries=self.process_max_tries)
+        def attempt():
+            return self.process_function(iter(rows))
+
+        return attempt()
+
+    def process_batch(self, it):
+        if not self.is_retrying_process():
+            return self.process_function(it.iterate())
+
+        batch = BatchBuffer(it.iterate(), spill_bytes=self.spill_bytes)
+
+        try:
+            return self.run_process_function(batch)
+        finally:
+            batch.close()
+
+    def flush(self):
+        linger = self.linger
+
+        if not linger or not linger.is_pending():
+            return
+
+        log.debug("Flushing {} records".format(len(linger.rows)))
+
+        # Rows (and the pending checkpoint) stay held if the sink fails
+        if linger.rows:
+            self.run_process_function(linger.rows)
+
+        if linger.offset:
+            self.sync_manager.set_last_offset(**linger.offset)
+
+        self.save()
+        linger.clear()
+
+    def _process(self, limit, i=0, stop_when_caught_up=False, max_bytes=None):
+
+        linger = self.linger
 
         for n in itertools.count():
 
             if self.should_stop(i=i, n=n):
                 break
 
+            if self.is_leased():
+                self.renew_lease()
+
             last_offset, it = self.get_last_offset_and_iterator(limit=limit)
 
             if not it:
                 break
 
-            self.process_function(it.iterate())
+            if max_bytes:
+                it.max_bytes = max_bytes
+
+            if linger:
+                linger.add(it.iterate())
+            else:
+                self.process_batch(it)
 
             if self.sync_manager.is_test_run:
                 log.debug("Stopping after iteration (test in progress). Processed {} records".format(it.n))
@@ -108,23 +500,39 @@ class Processor:
             if it.n == 0:
                 if stop_when_caught_up:
                     log.info("Caught up, stopping..")
+                    self.flush()
                     return
+                elif linger and linger.is_pending() and not linger.max_ms:
+                    # Nothing more to wait for
+                    self.flush()
                 else:
                     log.debug("Caught up, sleeping..")
-                    time.sleep(self.sleep_duration)
+                    # Grouped fsyncs (eg LogCheckpointStore) are otherwise only checked on the next save
+                    self.sync_manager.flush()
+                    remaining = linger.get_remaining() if linger else None
+                    time.sleep(self.sleep_duration if remaining is None else min(self.sleep_duration, remaining))
+                    self.check_connection = True
             else:
-                updated = self.update_offset(it=it, limit=limit, last_offset=last_offset)
+                # With linger the checkpoint is held until flush
+                updated = self.update_offset(it=it, limit=limit, last_offset=last_offset, store=linger)
                 if updated:
-                    self.save()
+                    if not linger:
+                        self.save()
                 else:
                     if stop_when_caught_up:
                         log.info("No changes, stopping..")
+                        self.flush()
                         return
 
+            if linger and linger.is_ready():
+                self.flush()
+
+        self.flush()
+
         log.info("Completed processing")
 
     def process_until_complete(self, limit):
-        return self.process(self, limit=limit, i=0, stop_when_caught_up=True)
+        return self.process(limit=limit, i=0, stop_when_caught_up=True)
 
 
 class AsyncProcessor(Processor):
@@ -133,7 +541,7 @@ class AsyncProcessor(Processor):
         super().__init__(sync_manager=sync_manager, it_function=it_function, process_function=process_function, sleep_duration=sleep_duration)
         self.object = object
 
-    @backoff.on_exception(backoff.expo, (OperationalError,), max_tries=PEEWEE_SYNC_BACKOFF_MAX_RETRIES)
+    @retry_on_operational_error()
     async def get_last_offset_and_iterator(self, limit):
 
         last_offset = self.sync_manager.get_last_offset()
@@ -145,7 +553,7 @@ class AsyncProcessor(Processor):
     async def save(self):
         await self.object.update(self.sync_manager)
 
-    async def process(self, limit, i=0, stop_when_caught_up=False):
+    async def process(self, limit, i=0, stop_when_caught_up=False, max_bytes=None):
 
         for n in itertools.count():
 
@@ -157,6 +565,9 @@ class AsyncProcessor(Processor):
             if not it:
                 break
 
+            if max_bytes:
+                it.max_bytes = max_bytes
+
             await self.process_function(it.iterate())
 
             if self.sync_manager.is_test_run:
@@ -169,6 +580,7 @@ class AsyncProcessor(Processor):
                     return
                 else:
                     log.info("Caught up, sleeping..")
+                    import asyncio
                     await asyncio.sleep(self.sleep_duration)
 
             else:
@@ -183,4 +595,4 @@ class AsyncProcessor(Processor):
         log.info("Completed importing")
 
     async def process_until_complete(self, limit):
-        return await self.process(self, limit=limit, i=0, stop_when_caught_up=True)
+        return await self.process(limit=limit, i=0, stop_when_caught_up=True)
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import logging
+from datetime import date
+from datetime import datetime
+
+log = logging.getLogger('peewee_syncer')
+
+
+def lock_file(f):
+    # Exclusive and non blocking, OSError if already locked. fcntl is POSIX only (and only imported when used)
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def unlock_file(f):
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class CheckpointStore:
+    """
+    Where the Processor keeps its last offset between batches (SyncManager is the peewee backend)
+
+    Subclasses implement get_meta/set_meta/save
+    """
+
+    is_test_run = False
+
+    @classmethod
+    def get_db(cls):
+        # Database to manage connections for (if any)
+        return None
+
+    def get_meta(self):
+        raise NotImplementedError
+
+    def set_meta(self, meta):
+        raise NotImplementedError
+
+    def save(self):
+        raise NotImplementedError
+
+    def flush(self):
+        # Make any buffered checkpoints durable
+        pass
+
+    def get_last_offset(self):
+
+        meta = self.get_meta()
+        value = meta.pop('value', None)
+        value_type = meta.pop('type', None)
+        offset = meta.pop('offset', None)
+
+        if value_type == 'date':
+            from dateutil import parser
+            value = parser.parse(value)
+
+        return {'value': value, 'offset': offset}
+
+    def set_last_offset(self, value, offset=0):
+
+        value_type = None
+
+        if isinstance(value, datetime) or isinstance(value, date):
+            value = value.isoformat()
+            value_type = "date"
+
+        self.set_meta({'value': value, "type": value_type, 'offset': offset})
+
+
+class LogCheckpointStore(CheckpointStore):
+    """
+    Append only local log of checkpoints (one JSON line per save)
+
+    fsync is grouped (every fsync_every saves or fsync_interval seconds, whichever is first, and on flush())
+    so a crash may lose the last few checkpoints (ie those batches are processed again).
+    The log is compacted down to the last checkpoint every compact_every saves
+
+    Only one process can open a log (exclusive lock on a sidecar .lock file, held until close)
+    """
+
+    def __init__(self, path, app=None, start=None, fsync_every=100, fsync_interval=1.0, compact_every=10000):
+        self.path = path
+        self.app = app or os.path.basename(path)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self.meta = None
+        self.modified = None
+        self.file = None
+        self.lock_file = None
+        self.records = 0
+        self.pending = 0
+        self.last_fsync = time.monotonic()
+
+        self.lock()
+
+        try:
+            self.load()
+
+            if self.meta is None:
+                if start is None:
+                    raise Exception("start required!")
+
+                self.set_last_offset(start, 0)
+                self.save()
+                self.flush()
+        except Exception:
+            self.close()
+            raise
+
+    def lock(self):
+        # Sidecar file as the log itself is replaced on compaction
+        f = open("{}.lock".format(self.path), "a")
+
+        try:
+            lock_file(f)
+        except OSError:
+            f.close()
+            raise Exception("{} is locked by another process!".format(self.path))
+
+        self.lock_file = f
+
+    def unlock(self):
+        if self.lock_file is not None:
+            unlock_file(self.lock_file)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def load(self):
+        try:
+            f = open(self.path, "rb+")
+        except FileNotFoundError:
+            return
+
+        with f:
+            size = 0
+
+            for line in f:
+                # A torn write (crash mid append) can only be the last line
+                if not line.endswith(b"\n"):
+                    break
+
+                record = json.loads(line)
+                self.meta = record['meta']
+                self.modified = record['modified']
+                self.records += 1
+                size += len(line)
+            else:
+                return
+
+            log.warning("Dropping partial checkpoint in {}".format(self.path))
+            f.truncate(size)
+
+    def get_meta(self):
+        return dict(self.meta)
+
+    def set_meta(self, meta):
+        self.meta = meta
+
+    def get_file(self):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        return self.file
+
+    def write(self, f):
+        f.write(json.dumps({'app': self.app, 'meta': self.meta, 'modified': self.modified}) + "\n")
+        f.flush()
+
+    def save(self):
+        self.modified = datetime.now().isoformat()
+
+        self.write(self.get_file())
+
+        self.records += 1
+        self.pending += 1
+
+        if self.pending >= self.fsync_every or time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.fsync()
+
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def fsync(self):
+        if self.file is not None and self.pending:
+            os.fsync(self.file.fileno())
+
+        self.pending = 0
+        self.last_fsync = time.monotonic()
+
+    def flush(self):
+        self.fsync()
+
+    def compact(self):
+        log.debug("Compacting {} ({} checkpoints)".format(self.path, self.records))
+
+        tmp = "{}.tmp".format(self.path)
+
+        with open(tmp, "w") as f:
+            self.write(f)
+            os.fsync(f.fileno())
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        os.replace(tmp, self.path)
+
+        # Make the rename durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self.records = 1
+        self.pending = 0
+        self.last_fsync = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        self.unlock()
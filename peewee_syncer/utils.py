@@ -1,6 +1,16 @@
+import io
+import uuid
+import decimal
+import datetime
 import itertools
+import logging
+from peewee import Node, Entity, Table, Column, SQL, PostgresqlDatabase, MySQLDatabase, __exception_wrapper__
 from .models import SyncManager
 
+__all__ = ['chunks', 'get_sync_manager', 'test_bulk', 'upsert_db_bulk', 'CompiledQuery', 'merge_db_bulk']
+
+log = logging.getLogger('peewee_syncer')
+
 
 def chunks(iterable, n):
     try:
@@ -44,6 +54,95 @@ def get_sync_manager(app, start, test=None, db=None, set_async=None):
     return state
 
 
+class QueryParam(Node):
+    """
+    Placeholder for an it_function argument (since/limit/offset) inside a CompiledQuery
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __sql__(self, ctx):
+        # Keep the field converter (if any) so it can be applied when the real value is bound
+        return ctx.value(_BoundParam(self.name, ctx.state.converter), converter=False)
+
+
+class _BoundParam:
+    def __init__(self, name, converter=None):
+        self.name = name
+        self.converter = converter
+
+    def bind(self, value):
+        if self.converter and value is not None:
+            return self.converter(value)
+        return value
+
+
+class _PersistentCursor:
+    """
+    Cursor proxy that ignores close() (peewee closes the cursor once a result set is exhausted)
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        pass
+
+
+class CompiledQuery:
+    """
+    Compiles a query once and re-executes the cached SQL with new since/limit/offset parameters
+
+    query_fun is called a single time with QueryParam placeholders instead of values,
+    so it must only pass them into the query (eg no python side logic on since/limit/offset)
+
+    The cursor is only reused while the connection stays open, ie use Processor(persistent_connection=True)
+    as otherwise each checkpoint save closes the connection (and a new cursor is created every batch)
+    """
+
+    def __init__(self, query_fun):
+        self.query = query_fun(since=QueryParam('since'), limit=QueryParam('limit'), offset=QueryParam('offset'))
+        self.sql, self.params = self.query.sql()
+        self.cursor = None
+        self.connection = None
+
+    def get_params(self, since, limit, offset):
+        values = {'since': since, 'limit': limit, 'offset': offset or 0}
+
+        return [p.bind(values[p.name]) if isinstance(p, _BoundParam) else p for p in self.params]
+
+    def get_cursor(self):
+        db = self.query._database
+        connection = db.connection()
+
+        # Connection may have been closed/reopened (eg by a connection_context() on save)
+        if self.cursor is None or self.connection is not connection:
+            self.cursor = _PersistentCursor(db.cursor())
+            self.connection = connection
+
+        return self.cursor
+
+    def execute(self, since, limit, offset=0):
+        params = self.get_params(since=since, limit=limit, offset=offset)
+        log.debug((self.sql, params))
+
+        with __exception_wrapper__:
+            cursor = self.get_cursor()
+            cursor.execute(self.sql, params)
+
+        return self.query._get_cursor_wrapper(cursor)
+
+    def iterator(self, since, limit, offset=0):
+        return self.execute(since=since, limit=limit, offset=offset).iterator()
+
+
 def test_bulk(it):
     import pprint
     for item in it:
@@ -67,3 +166,138 @@ def upsert_db_bulk(model, it, preserve=[], conflict_target=None):
 
         if n % 50 == 0:
             print(".", end="", flush=True)
+
+
+def _sql(db, node):
+    return db.get_sql_context().sql(node).query()[0]
+
+
+# Values with a known COPY text representation (anything else, eg json/array adapters, uses executemany)
+COPY_TYPES = (str, int, float, decimal.Decimal, datetime.date, datetime.time, uuid.UUID, bytes, bytearray, memoryview)
+
+
+def _unwrap_binary(value):
+    # BlobField.db_value() wraps bytes in psycopg2.Binary
+    adapted = getattr(value, 'adapted', None)
+
+    if isinstance(adapted, (bytes, bytearray, memoryview)):
+        return bytes(adapted)
+
+    return value
+
+
+def _is_copy_value(value):
+    return value is None or isinstance(value, COPY_TYPES)
+
+
+def _copy_value(value):
+    # Postgres COPY text format
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea hex format (backslash escaped for COPY)
+        return '\\\\x' + bytes(value).hex()
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def drop_staging(db, name):
+    # Always qualified so a permanent table of the same name can't be dropped
+    if isinstance(db, MySQLDatabase):
+        sql = "DROP TEMPORARY TABLE IF EXISTS {}".format(_sql(db, Entity(name)))
+    elif isinstance(db, PostgresqlDatabase):
+        sql = "DROP TABLE IF EXISTS {}".format(_sql(db, Entity('pg_temp', name)))
+    else:
+        sql = "DROP TABLE IF EXISTS {}".format(_sql(db, Entity('temp', name)))
+
+    db.execute_sql(sql)
+
+
+def load_staging(db, staging, columns, rows, chunk_size=1000):
+
+    cursor = db.cursor()
+    name = _sql(db, Entity(staging.__name__))
+
+    if isinstance(db, PostgresqlDatabase) and hasattr(cursor, 'copy_expert'):
+        rows = [tuple(_unwrap_binary(v) for v in row) for row in rows]
+
+        if not all(_is_copy_value(v) for row in rows for v in row):
+            log.debug("Non scalar values, loading staging table with executemany")
+            return _executemany_staging(db, cursor, name, columns, rows)
+
+        buffer = io.StringIO()
+
+        for row in rows:
+            buffer.write("\t".join(_copy_value(v) for v in row))
+            buffer.write("\n")
+
+        buffer.seek(0)
+
+        sql = "COPY {} ({}) FROM STDIN".format(name, ", ".join(_sql(db, Entity(c)) for c in columns))
+
+        with __exception_wrapper__:
+            cursor.copy_expert(sql, buffer)
+
+    elif isinstance(db, MySQLDatabase):
+        # Multi row VALUES
+        for items in chunks(rows, chunk_size):
+            staging.insert(list(items), columns=[Column(staging, c) for c in columns]).execute()
+
+    else:
+        _executemany_staging(db, cursor, name, columns, rows)
+
+
+def _executemany_staging(db, cursor, name, columns, rows):
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        name,
+        ", ".join(_sql(db, Entity(c)) for c in columns),
+        ", ".join(db.param for _ in columns)
+    )
+
+    with __exception_wrapper__:
+        cursor.executemany(sql, rows)
+
+
+def merge_db_bulk(model, it, preserve=[], conflict_target=None, chunk_size=1000):
+    """
+    Alternative to upsert_db_bulk for large batches.
+    Loads rows into a temporary staging table then merges into the model table with a single INSERT .. SELECT
+    """
+
+    it = iter(it)
+
+    try:
+        first = next(it)
+    except StopIteration:
+        return
+
+    fields = [model._meta.fields[name] for name in first]
+    columns = [field.column_name for field in fields]
+
+    rows = (tuple(field.db_value(row[field.name]) for field in fields) for row in itertools.chain((first,), it))
+
+    db = model._meta.database
+    table = Entity(model._meta.schema, model._meta.table_name) if model._meta.schema else Entity(model._meta.table_name)
+    staging = Table("{}_staging".format(model._meta.table_name), columns).bind(db)
+    name = _sql(db, Entity(staging.__name__))
+
+    with db.atomic():
+        drop_staging(db, staging.__name__)
+        db.execute_sql("CREATE TEMPORARY TABLE {} AS SELECT * FROM {} WHERE 1 = 0".format(name, _sql(db, table)))
+
+        load_staging(db, staging, columns, rows, chunk_size=chunk_size)
+
+        # WHERE is required for sqlite to parse INSERT .. SELECT .. ON CONFLICT
+        query = staging.select(*[Column(staging, c) for c in columns]).where(SQL("1 = 1"))
+
+        model.insert_from(query, fields).on_conflict(
+            action='UPDATE',
+            preserve=preserve,
+            conflict_target=conflict_target
+        ).execute()
+
+        drop_staging(db, staging.__name__)
@@ -19,6 +19,9 @@ setup(name='peewee-syncer',
           'Programming Language :: Python :: 3'
       ],
       packages=['peewee_syncer'],
+      entry_points={
+          'console_scripts': ['peewee-syncer=peewee_syncer.cli:main'],
+      },
       install_requires=[
             'peewee>=3.8.1',
             'python-dateutil>=2.7.5',
@@ -1,12 +1,17 @@
 import os
+import sys
+import json
 import logging
 import asyncio
+import subprocess
 from dotenv import load_dotenv
-from unittest import TestCase
+from unittest import TestCase, mock
 from peewee import Proxy
 from peewee_async import MySQLDatabase as AsyncMySQLDatabase, Manager
-from peewee import SqliteDatabase, Model, IntegerField
-from peewee_syncer import SyncManager, get_sync_manager, Processor, AsyncProcessor, LastOffsetQueryIterator
+from peewee import SqliteDatabase, Model, IntegerField, TextField
+from peewee_syncer import SyncManager, get_sync_manager, Processor, AsyncProcessor, LastOffsetQueryIterator, CompiledQuery, merge_db_bulk, LeaseLost, \
+    LogCheckpointStore
+from peewee_syncer.cli import main
 
 logging.getLogger('peewee').setLevel(logging.INFO)
 
@@ -16,6 +21,29 @@ load_dotenv()
 
 log = logging.getLogger(__name__)
 
+
+# used by the cli test (loaded via "tests:...")
+cli_db = SqliteDatabase('test.db')
+cli_output = []
+
+
+class CliModel(Model):
+
+    value = IntegerField()
+
+    class Meta:
+        database = cli_db
+
+
+def cli_it(since, limit, offset):
+    q = CliModel.select().where(CliModel.id > since).limit(limit)
+    return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id, key_fun=lambda x: x.id, is_unique_key=True)
+
+
+def cli_process(it):
+    cli_output.extend(it)
+
+
 class BaseTestCase(TestCase):
 
     def get_sqlite_db(self):
@@ -220,6 +248,803 @@ class SyncerTests(BaseTestCase):
         self.assertEqual(ids[-1], 50)
 
 
+    def test_compiled_query(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            @classmethod
+            def get_key(cls, item):
+                return item.value
+
+            @classmethod
+            def select_since_value(cls, since, limit, offset):
+                return cls.select().where(cls.value > since).order_by(cls.value).limit(limit).offset(offset)
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        sync_manager = get_sync_manager(app="test",
+                                        start=-1,
+                                        test=None
+                                        )
+
+        output = []
+
+        def row_output(model):
+            data = {'id': model.id, 'value': model.value}
+            output.append(data)
+            return data
+
+        # 15 regular, 25 @ 50 (ie the "hump"), 10 afterwards
+        for i in range(15):
+            TestModel.create(value=i)
+
+        for i in range(25):
+            TestModel.create(value=50)
+
+        for i in range(10):
+            TestModel.create(value=51+i)
+
+        query = CompiledQuery(TestModel.select_since_value)
+
+        self.assertNotIn("50", query.sql)
+
+        def process(it):
+            for x in it:
+                log.debug("process id={} value={}".format(x['id'], x['value']))
+
+        def it(since, limit, offset):
+            return LastOffsetQueryIterator(query.iterator(since=since, limit=limit, offset=offset),
+                                           row_output_fun=row_output,
+                                           key_fun=TestModel.get_key, is_unique_key=False)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=process,
+            sleep_duration=0
+        )
+
+        processor.process(limit=10, i=10)
+
+        value_ids = sorted(set([x['value'] for x in output]))
+        self.assertEqual(value_ids, list(range(15)) + [50] + list(range(51, 61)))
+
+        ids = sorted(set([x['id'] for x in output]))
+        self.assertEqual(len(ids), 50)
+
+
+    def test_compiled_query_cursor_reuse(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        sync_manager = get_sync_manager(app="test", start=0)
+
+        query = CompiledQuery(lambda since, limit, offset: TestModel.select().where(TestModel.id > since).order_by(TestModel.id).limit(limit).offset(offset))
+
+        output = []
+        cursors = []
+
+        def it(since, limit, offset):
+            rows = query.iterator(since=since, limit=limit, offset=offset)
+            cursors.append(query.cursor)
+            return LastOffsetQueryIterator(rows, row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=output.extend,
+            sleep_duration=0,
+            persistent_connection=True
+        )
+
+        processor.process(limit=10, stop_when_caught_up=True)
+
+        self.assertEqual(output, list(range(1, 26)))
+
+        # 3 batches + caught up, all on the same cursor
+        self.assertEqual(len(cursors), 4)
+        self.assertTrue(all(cursor is cursors[0] for cursor in cursors))
+
+    def test_persistent_connection(self):
+
+        connects = 0
+        checks = 0
+
+        class CountingSqliteDatabase(SqliteDatabase):
+            def _connect(self):
+                nonlocal connects
+                connects += 1
+                return super()._connect()
+
+            def is_connection_usable(self):
+                nonlocal checks
+                checks += 1
+                return super().is_connection_usable()
+
+        self.get_sqlite_db()
+        db = CountingSqliteDatabase('test.db')
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        sync_manager = get_sync_manager(app="test", start=0)
+
+        db.close()
+        connects = 0
+
+        output = []
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=output.extend,
+            sleep_duration=0,
+            persistent_connection=True
+        )
+
+        processor.process(limit=10, i=5)
+
+        self.assertEqual(output, list(range(1, 26)))
+        self.assertEqual(connects, 1)
+        self.assertTrue(db.is_closed())
+
+        # Health checked after the (first) caught up sleep only, not per batch or checkpoint
+        # (nothing to check on first use as the connection starts closed)
+        self.assertEqual(checks, 1)
+
+
+    def test_copy_values(self):
+        from peewee_syncer.utils import _copy_value, _is_copy_value, _unwrap_binary
+
+        class Binary:
+            # eg psycopg2.Binary
+            def __init__(self, adapted):
+                self.adapted = adapted
+
+        self.assertEqual(_copy_value(None), "\\N")
+        self.assertEqual(_copy_value(True), "t")
+        self.assertEqual(_copy_value("a\tb\\c\n"), "a\\tb\\\\c\\n")
+        self.assertEqual(_copy_value(_unwrap_binary(Binary(b"\x00\xff"))), "\\\\x00ff")
+
+        # json/array adapters are left to executemany
+        self.assertFalse(_is_copy_value({"a": 1}))
+        self.assertFalse(_is_copy_value([1, 2]))
+        self.assertFalse(_is_copy_value(Binary({"a": 1})))
+
+    def test_max_bytes(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+            blob = TextField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        # Mix of small and large rows, with a "hump" of same value
+        for i in range(15):
+            TestModel.create(value=i, blob="x" * (1000 if i % 5 == 0 else 10))
+
+        for i in range(25):
+            TestModel.create(value=50, blob="x" * (1000 if i % 5 == 0 else 10))
+
+        for i in range(10):
+            TestModel.create(value=51+i, blob="x" * 10)
+
+        sync_manager = get_sync_manager(app="test", start=-1)
+
+        output = []
+        batches = []
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.value > since).order_by(TestModel.value, TestModel.id).limit(limit).offset(offset)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.value, is_unique_key=False)
+
+        def process(it):
+            batch = list(it)
+            batches.append(batch)
+            output.extend(batch)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=process,
+            sleep_duration=0
+        )
+
+        processor.process(limit=10, i=50, stop_when_caught_up=True, max_bytes=1000)
+
+        # Caught up well before the iteration limit
+        self.assertLess(len(batches), 50)
+
+        # Batches are cut short when a large row is seen
+        self.assertTrue(any(len(batch) < 10 for batch in batches[:-1]))
+        self.assertEqual(sorted(set(output)), list(range(1, 51)))
+
+
+    def test_merge_db_bulk(self):
+
+        db = self.get_sqlite_db()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+            name = TextField(null=True)
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        # A permanent table with the staging name must not be touched
+        db.execute_sql('CREATE TABLE "testmodel_staging" ("id" INTEGER)')
+
+        for i in range(10):
+            TestModel.create(id=i + 1, value=0, name="old")
+
+        rows = [{'id': i + 1, 'value': i + 1, 'name': None if i % 2 else "new\t{}".format(i)} for i in range(25)]
+
+        merge_db_bulk(TestModel, iter(rows), preserve=[TestModel.value, TestModel.name], conflict_target=[TestModel.id])
+
+        self.assertEqual(TestModel.select().count(), 25)
+
+        merged = {x.id: x for x in TestModel.select()}
+        self.assertEqual([merged[i + 1].value for i in range(25)], list(range(1, 26)))
+        self.assertEqual(merged[1].name, "new\t0")
+        self.assertIsNone(merged[2].name)
+
+        # Temporary staging table is dropped, the permanent one is left alone
+        self.assertIn("testmodel_staging", db.get_tables())
+        self.assertEqual(db.execute_sql("SELECT COUNT(*) FROM temp.sqlite_master").fetchone()[0], 0)
+
+        # No rows is a no-op
+        merge_db_bulk(TestModel, iter([]))
+
+
+    def test_linger(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        sync_manager = get_sync_manager(app="test", start=0)
+
+        batches = []
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=lambda it: batches.append(list(it)),
+            sleep_duration=0,
+            linger_rows=20,
+            linger_ms=60000
+        )
+
+        processor.process(limit=5, i=20, stop_when_caught_up=True)
+
+        # Four iterations held until 20 rows, remainder flushed when caught up
+        self.assertEqual([len(batch) for batch in batches], [20, 5])
+        self.assertEqual(sum(batches, []), list(range(1, 26)))
+        self.assertEqual(SyncManager.get(app="test").get_last_offset()['value'], 25)
+
+
+    def test_linger_failed_flush(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        sync_manager = get_sync_manager(app="test", start=0)
+
+        output = []
+        failed = False
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        def process(it):
+            nonlocal failed
+            rows = list(it)
+
+            # Sink fails once (eg deadlock)
+            if not failed:
+                failed = True
+                raise RuntimeError("deadlock")
+
+            output.extend(rows)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=process,
+            sleep_duration=0,
+            linger_rows=20,
+            linger_ms=60000
+        )
+
+        with self.assertRaises(RuntimeError):
+            processor.process(limit=5, stop_when_caught_up=True)
+
+        # Nothing checkpointed
+        self.assertEqual(SyncManager.get(app="test").get_last_offset()['value'], 0)
+
+        # Outer retry, held rows are delivered
+        processor.process(limit=5, stop_when_caught_up=True)
+
+        self.assertEqual(output, list(range(1, 26)))
+        self.assertEqual(SyncManager.get(app="test").get_last_offset()['value'], 25)
+
+    def test_import_is_lazy(self):
+        code = "import sys, peewee_syncer; print(sorted(m for m in ('asyncio', 'backoff', 'dateutil', 'fcntl') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, "-c", code])
+
+        self.assertEqual(output.strip(), b"[]")
+
+    def test_cli(self):
+
+        self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        CliModel.create_table()
+
+        for i in range(25):
+            CliModel.create(id=i + 1, value=i + 1)
+
+        with open('test.json', 'w') as f:
+            json.dump({
+                "database": "tests:cli_db",
+                "jobs": [
+                    {"app": "test", "start": 0, "it_function": "tests:cli_it", "process_function": "tests:cli_process", "limit": 10, "sleep_duration": 0},
+                    {"app": "other", "start": 0, "it_function": "tests:cli_it", "process_function": "tests:cli_process", "limit": 10}
+                ]
+            }, f)
+
+        main(["test.json", "--create-table", "--job", "test"])
+
+        self.assertEqual(cli_output, list(range(1, 26)))
+        self.assertEqual(SyncManager.get(app="test").get_last_offset()['value'], 25)
+        self.assertFalse(SyncManager.select().where(SyncManager.app == "other").exists())
+
+        # Continues from the saved offset
+        CliModel.create(id=26, value=26)
+        main(["test.json", "--job", "test"])
+
+        self.assertEqual(cli_output, list(range(1, 27)))
+
+        os.remove('test.json')
+
+
+    def test_lease(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+        SyncManager.create_lease_table()
+
+        # Lease lives in its own table, sync_manager keeps the original schema
+        self.assertEqual([c.name for c in db.get_columns("sync_manager")], ["app", "meta", "modified"])
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        get_sync_manager(app="test", start=0)
+
+        output = []
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        def get_processor(owner, process_function=output.extend):
+            return Processor(
+                sync_manager=get_sync_manager(app="test", start=None),
+                it_function=it,
+                process_function=process_function,
+                sleep_duration=0,
+                lease_owner=owner
+            )
+
+        a = SyncManager.get(app="test")
+        self.assertTrue(a.acquire_lease(owner="a", duration=60))
+        self.assertEqual(a.lease_token, 1)
+        self.assertFalse(SyncManager.get(app="test").acquire_lease(owner="x", duration=60))
+
+        # Held by "a"
+        get_processor("b").process(limit=10, stop_when_caught_up=True)
+        self.assertEqual(output, [])
+
+        self.assertTrue(a.renew_lease(duration=60))
+        self.assertTrue(a.release_lease())
+
+        get_processor("b").process(limit=10, stop_when_caught_up=True)
+        self.assertEqual(output, list(range(1, 26)))
+
+        # Lease is released when done
+        b = SyncManager.get(app="test").get_lease()
+        self.assertIsNone(b.owner)
+        self.assertEqual(b.token, 2)
+
+        # Expiry is checked against the database clock
+        self.assertTrue(SyncManager.get(app="test").acquire_lease(owner="x", duration=-10))
+        self.assertTrue(SyncManager.get(app="test").acquire_lease(owner="y", duration=60))
+        self.assertFalse(SyncManager.get(app="test").acquire_lease(owner="x", duration=60))
+        SyncManager.get_lease_model().update(owner=None).execute()
+
+        # Stolen mid run, checkpoint is refused
+        TestModel.create(id=26, value=26)
+
+        def steal(it):
+            list(it)
+            self.assertTrue(SyncManager.get(app="test").steal_lease(owner="c", duration=60))
+
+        with self.assertRaises(LeaseLost):
+            get_processor("b", process_function=steal).process(limit=10, stop_when_caught_up=True)
+
+        c = SyncManager.get(app="test")
+        self.assertEqual(c.get_lease().owner, "c")
+        self.assertEqual(c.get_last_offset()['value'], 25)
+
+
+    def test_lease_linger_handover(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+        SyncManager.create_lease_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        get_sync_manager(app="test", start=0)
+
+        output = []
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        def fail(it):
+            raise RuntimeError("deadlock")
+
+        a = Processor(
+            sync_manager=get_sync_manager(app="test", start=None),
+            it_function=it,
+            process_function=fail,
+            sleep_duration=0,
+            linger_rows=20,
+            linger_ms=60000,
+            lease_owner="a"
+        )
+
+        # "a" fails to flush, rows (and offset) stay held
+        with self.assertRaises(RuntimeError):
+            a.process(limit=5, stop_when_caught_up=True)
+
+        b = Processor(
+            sync_manager=get_sync_manager(app="test", start=None),
+            it_function=it,
+            process_function=output.extend,
+            sleep_duration=0,
+            lease_owner="b"
+        )
+
+        b.process(limit=5, stop_when_caught_up=True)
+        self.assertEqual(output, list(range(1, 26)))
+
+        # "a" takes the lease back, held rows are dropped and it continues from b's checkpoint
+        a.process_function = output.extend
+        a.process(limit=5, stop_when_caught_up=True)
+
+        self.assertEqual(output, list(range(1, 26)))
+        self.assertEqual(SyncManager.get(app="test").get_last_offset()['value'], 25)
+
+    def test_process_retry(self):
+
+        db = self.get_sqlite_db()
+
+        # Re proxy to avoid previous test use
+        SyncManager._meta.database = Proxy()
+
+        SyncManager.init_db(db)
+
+        SyncManager.create_table()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        sync_manager = get_sync_manager(app="test", start=0)
+
+        queries = 0
+
+        def it(since, limit, offset):
+            nonlocal queries
+            queries += 1
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: {'id': x.id, 'value': x.value},
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        output = []
+        failures = 0
+
+        def process(it):
+            nonlocal failures
+            rows = list(it)
+
+            # Fail twice per batch (eg deadlock)
+            if failures < 2:
+                failures += 1
+                raise RuntimeError("deadlock")
+
+            failures = 0
+            output.extend(x['id'] for x in rows)
+
+        processor = Processor(
+            sync_manager=sync_manager,
+            it_function=it,
+            process_function=process,
+            sleep_duration=0,
+            process_max_tries=3,
+            # Spill to disk part way through each batch
+            spill_bytes=50
+        )
+
+        with mock.patch('time.sleep'):
+            processor.process(limit=10, stop_when_caught_up=True)
+
+        self.assertEqual(output, list(range(1, 26)))
+
+        # 3 batches + caught up, none re-fetched
+        self.assertEqual(queries, 4)
+
+
+    def test_log_checkpoint_store(self):
+
+        db = self.get_sqlite_db()
+
+        class TestModel(Model):
+
+            value = IntegerField()
+
+            class Meta:
+                database = db
+
+        TestModel.create_table()
+
+        for i in range(25):
+            TestModel.create(id=i + 1, value=i + 1)
+
+        for path in ('test.log', 'test.log.lock'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        output = []
+
+        def it(since, limit, offset):
+            q = TestModel.select().where(TestModel.id > since).limit(limit)
+            return LastOffsetQueryIterator(q.iterator(), row_output_fun=lambda x: x.id,
+                                           key_fun=lambda x: x.id, is_unique_key=True)
+
+        def get_processor(store):
+            return Processor(
+                sync_manager=store,
+                it_function=it,
+                process_function=output.extend,
+                sleep_duration=0
+            )
+
+        with self.assertRaises(Exception):
+            LogCheckpointStore('test.log')
+
+        store = LogCheckpointStore('test.log', start=0, compact_every=3)
+        get_processor(store).process(limit=5, stop_when_caught_up=True)
+        store.close()
+
+        self.assertEqual(output, list(range(1, 26)))
+
+        # 6 checkpoints (start + 5 batches), compacted to one line every 3
+        with open('test.log') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        # Torn write is dropped on load
+        with open('test.log', 'a') as f:
+            f.write('{"app": "test.log", "me')
+
+        TestModel.create(id=26, value=26)
+
+        store = LogCheckpointStore('test.log')
+        self.assertEqual(store.get_last_offset(), {'value': 25, 'offset': 0})
+
+        get_processor(store).process(limit=5, stop_when_caught_up=True)
+        store.close()
+
+        self.assertEqual(output, list(range(1, 27)))
+
+        # Only one process (open store) per log
+        store = LogCheckpointStore('test.log', compact_every=3)
+        self.assertEqual(store.get_last_offset()['value'], 26)
+
+        with self.assertRaises(Exception):
+            LogCheckpointStore('test.log')
+
+        # Lock is still held after compaction
+        for i in range(5):
+            store.set_last_offset(27 + i, 0)
+            store.save()
+
+        self.assertLess(store.records, 3)
+
+        with self.assertRaises(Exception):
+            LogCheckpointStore('test.log')
+
+        store.close()
+        LogCheckpointStore('test.log').close()
+
+        # Checkpoints are fsynced before sleeping while caught up
+        store = LogCheckpointStore('test.log', fsync_every=100, fsync_interval=3600)
+        pending = []
+
+        with mock.patch('time.sleep', side_effect=lambda s: pending.append(store.pending)):
+            TestModel.create(id=40, value=40)
+            get_processor(store).process(limit=5, i=3)
+
+        self.assertEqual(pending, [0, 0])
+        store.close()
+
+        os.remove('test.log')
+        os.remove('test.log.lock')
+
+
 class AsyncSyncerTests(BaseTestCase):
     """
     Async Syncer Tests